@@ -6,17 +6,18 @@ Created on Nov 2, 2018
 @author: Quentin Lutz <qlutz@enst.fr>
 @author: Thomas Bonald <bonald@enst.fr>
 """
+from multiprocessing.pool import ThreadPool
+from os import cpu_count
 from typing import Union, Optional
 
 import numpy as np
 from scipy import sparse
 
 from sknetwork.clustering.base import BaseClustering, BaseBiClustering
-from sknetwork.clustering.louvain_core import fit_core
+from sknetwork.clustering.louvain_core import aggregate_core, fit_core
 from sknetwork.clustering.postprocess import reindex_labels
-from sknetwork.utils.check import check_format, check_random_state, check_probs, check_square
-from sknetwork.utils.format import bipartite2directed, directed2undirected, bipartite2undirected
-from sknetwork.utils.membership import membership_matrix
+from sknetwork.utils.check import check_format, check_random_state, check_probs, check_square, check_n_jobs
+from sknetwork.utils.format import bipartite2directed, bipartite2undirected
 from sknetwork.utils.verbose import VerboseMixin
 
 
@@ -40,7 +41,17 @@ class Louvain(BaseClustering, VerboseMixin):
         Maximum number of aggregations.
         A negative value is interpreted as no limit.
     shuffle_nodes :
-        Enables node shuffling before optimization.
+        Enables node shuffling before optimization. The order of the nodes is then carried over to the aggregate graphs.
+    parallelize :
+        If ``True``, search the best move of each node in parallel during each optimization pass.
+        Moves are searched from the labels at the start of the pass, then applied sequentially.
+        The number of threads is that of OpenMP (see ``OMP_NUM_THREADS``), each using extra memory linear in the
+        number of nodes.
+    n_jobs :
+        If an integer value is given, denotes the number of workers to use (-1 means the maximum number will be used).
+        Connected components are then clustered independently, in parallel.
+        If the graph has several connected components, this takes precedence over ``parallelize``.
+        If ``None``, no parallel computations are made.
     sort_clusters :
             If ``True``, sort labels in decreasing order of cluster size.
     return_membership :
@@ -90,7 +101,8 @@ class Louvain(BaseClustering, VerboseMixin):
     """
     def __init__(self, resolution: float = 1, modularity: str = 'dugue', tol_optimization: float = 1e-3,
                  tol_aggregation: float = 1e-3, n_aggregations: int = -1, shuffle_nodes: bool = False,
-                 sort_clusters: bool = True, return_membership: bool = True, return_aggregate: bool = True,
+                 parallelize: bool = False, n_jobs: Optional[int] = None, sort_clusters: bool = True,
+                 return_membership: bool = True, return_aggregate: bool = True,
                  random_state: Optional[Union[np.random.RandomState, int]] = None, verbose: bool = False):
         super(Louvain, self).__init__(sort_clusters=sort_clusters, return_membership=return_membership,
                                       return_aggregate=return_aggregate)
@@ -102,19 +114,27 @@ class Louvain(BaseClustering, VerboseMixin):
         self.tol_aggregation = tol_aggregation
         self.n_aggregations = n_aggregations
         self.shuffle_nodes = shuffle_nodes
+        self.parallelize = parallelize
+        self.n_jobs = n_jobs
         self.random_state = check_random_state(random_state)
 
-    def _optimize(self, adjacency_norm, probs_ou, probs_in):
+    def _optimize(self, adjacency_norm, probs_ou, probs_in, nodes=None, tol=None, parallelize: bool = False):
         """One local optimization pass of the Louvain algorithm
 
         Parameters
         ----------
         adjacency_norm :
-            the norm of the adjacency
+            the norm of the symmetrized adjacency (CSR format)
         probs_ou :
             the array of degrees of the adjacency
         probs_in :
             the array of degrees of the transpose of the adjacency
+        nodes :
+            the order in which nodes are considered (default: natural order)
+        tol :
+            the minimum increase in modularity to enter a new optimization pass (default: ``tol_optimization``)
+        parallelize :
+            if ``True``, search the best move of each node in parallel
 
         Returns
         -------
@@ -123,43 +143,171 @@ class Louvain(BaseClustering, VerboseMixin):
         pass_increase :
             the increase in modularity gained after optimization
         """
-        node_probs_in = probs_in.astype(np.float32)
-        node_probs_ou = probs_ou.astype(np.float32)
+        node_probs_in = probs_in.astype(np.float32, copy=False)
+        node_probs_ou = probs_ou.astype(np.float32, copy=False)
 
-        adjacency = 0.5 * directed2undirected(adjacency_norm)
+        self_loops = adjacency_norm.diagonal().astype(np.float32, copy=False)
 
-        self_loops = adjacency.diagonal().astype(np.float32)
+        indptr: np.ndarray = adjacency_norm.indptr
+        indices: np.ndarray = adjacency_norm.indices
+        data: np.ndarray = adjacency_norm.data.astype(np.float32, copy=False)
 
-        indptr: np.ndarray = adjacency.indptr
-        indices: np.ndarray = adjacency.indices
-        data: np.ndarray = adjacency.data.astype(np.float32)
+        if nodes is None:
+            nodes = np.arange(adjacency_norm.shape[0], dtype=indices.dtype)
+        else:
+            nodes = nodes.astype(indices.dtype)
+
+        if tol is None:
+            tol = self.tol
 
-        return fit_core(self.resolution, self.tol, node_probs_ou, node_probs_in, self_loops, data, indices, indptr)
+        return fit_core(self.resolution, tol, node_probs_ou, node_probs_in, self_loops, data, indices, indptr,
+                        nodes, parallelize)
 
     @staticmethod
-    def _aggregate(adjacency_norm, probs_ou, probs_in, membership: Union[sparse.csr_matrix, np.ndarray]):
+    def _aggregate(adjacency_norm, probs_ou, probs_in, labels: np.ndarray):
         """Aggregate nodes belonging to the same cluster.
 
         Parameters
         ----------
         adjacency_norm :
-            the norm of the adjacency
+            the norm of the symmetrized adjacency (CSR format)
         probs_ou :
             the array of degrees of the adjacency
         probs_in :
             the array of degrees of the transpose of the adjacency
-        membership :
-            membership matrix (rows).
+        labels :
+            the cluster of each node (from 0 to k - 1, with k the number of clusters)
 
         Returns
         -------
         Aggregate graph.
         """
-        adjacency_norm = (membership.T.dot(adjacency_norm.dot(membership))).tocsr()
-        probs_in = np.array(membership.T.dot(probs_in).T)
-        probs_ou = np.array(membership.T.dot(probs_ou).T)
+        n_labels = labels.max() + 1
+        indices: np.ndarray = adjacency_norm.indices
+        data, indices, indptr = aggregate_core(adjacency_norm.data.astype(np.float32, copy=False), indices,
+                                               adjacency_norm.indptr, labels.astype(indices.dtype), n_labels)
+        adjacency_norm = sparse.csr_matrix((data, indices, indptr), shape=(n_labels, n_labels))
+        probs_in = np.bincount(labels, weights=probs_in, minlength=n_labels).astype(np.float32)
+        probs_ou = np.bincount(labels, weights=probs_ou, minlength=n_labels).astype(np.float32)
         return adjacency_norm, probs_ou, probs_in
 
+    def _fit_component(self, adjacency_norm, probs_ou, probs_in, nodes=None, weight: float = 1,
+                       parallelize: bool = False) -> np.ndarray:
+        """Successive optimization and aggregation passes of the Louvain algorithm.
+
+        Parameters
+        ----------
+        adjacency_norm :
+            the norm of the symmetrized adjacency (CSR format)
+        probs_ou :
+            the array of degrees of the adjacency
+        probs_in :
+            the array of degrees of the transpose of the adjacency
+        nodes :
+            the order in which nodes are considered (default: natural order), carried over to the aggregate graphs
+        weight :
+            the total weight of the graph, to which the tolerances are scaled
+        parallelize :
+            if ``True``, search the best move of each node in parallel
+
+        Returns
+        -------
+        labels :
+            the cluster of each node (from 0 to k - 1, with k the number of clusters)
+        """
+        n = adjacency_norm.shape[0]
+        labels = np.arange(n)
+        tol = np.float32(self.tol * weight)
+        tol_aggregation = self.tol_aggregation * weight
+        increase = True
+        count_aggregations = 0
+        while increase:
+            count_aggregations += 1
+
+            labels_clust, pass_increase = self._optimize(adjacency_norm, probs_ou, probs_in, nodes, tol, parallelize)
+            clusters, labels_clust = np.unique(labels_clust, return_inverse=True)
+            if nodes is not None:
+                # clusters of the aggregate graph are visited in the order of their first node
+                rank = np.empty_like(nodes)
+                rank[nodes] = np.arange(len(nodes))
+                nodes = np.argsort(rank[clusters])
+
+            # no aggregation if no node has moved
+            if pass_increase <= tol_aggregation or labels_clust.max() + 1 == n:
+                increase = False
+            else:
+                labels = labels_clust[labels]
+                adjacency_norm, probs_ou, probs_in = self._aggregate(adjacency_norm, probs_ou, probs_in, labels_clust)
+
+                n = adjacency_norm.shape[0]
+                if n == 1:
+                    break
+            self.log.print("Aggregation", count_aggregations, "completed with", n, "clusters and ",
+                           pass_increase, "increment.")
+            if count_aggregations == self.n_aggregations:
+                break
+        return labels
+
+    def _fit_components(self, adjacency_norm, probs_ou, probs_in, nodes, components, n_jobs) -> np.ndarray:
+        """Apply the Louvain algorithm to groups of connected components independently.
+
+        Parameters
+        ----------
+        adjacency_norm :
+            the norm of the symmetrized adjacency (CSR format)
+        probs_ou :
+            the array of degrees of the adjacency
+        probs_in :
+            the array of degrees of the transpose of the adjacency
+        nodes :
+            the order in which nodes are considered (default: natural order)
+        components :
+            the connected component of each node
+        n_jobs :
+            the number of workers (``None`` means the maximum number)
+
+        Returns
+        -------
+        labels :
+            the cluster of each node (from 0 to k - 1, with k the number of clusters)
+        """
+        # consecutive components are grouped in blocks of similar number of edges, one block per worker
+        n_blocks = n_jobs or cpu_count() or 1
+        nnz_components = np.bincount(components, weights=np.diff(adjacency_norm.indptr))
+        nnz_cumulated = np.cumsum(nnz_components) - nnz_components
+        blocks_components = (nnz_cumulated * n_blocks // max(adjacency_norm.nnz, 1)).astype(int)
+        sizes_blocks = np.bincount(blocks_components, weights=np.bincount(components)).astype(int)
+        bounds = np.unique(np.concatenate(([0], np.cumsum(sizes_blocks))))
+
+        # nodes sorted by component, so that each block is a diagonal block
+        index = np.argsort(components, kind='stable')
+        adjacency_norm = adjacency_norm[index][:, index]
+        if nodes is not None:
+            rank = np.empty_like(nodes)
+            rank[nodes] = np.arange(len(nodes))
+            rank = rank[index]
+
+        blocks = list(zip(bounds[:-1], bounds[1:]))
+        tasks = []
+        for start, end in blocks:
+            adjacency_block = adjacency_norm[start:end, start:end]
+            if nodes is None:
+                nodes_block = None
+            else:
+                nodes_block = np.argsort(rank[start:end])
+            # tolerances are relative to the weight of the block, moves are searched sequentially in each worker
+            tasks.append((adjacency_block, probs_ou[index[start:end]], probs_in[index[start:end]], nodes_block,
+                          adjacency_block.data.sum(), False))
+        with ThreadPool(n_jobs) as pool:
+            labels_blocks = pool.starmap(self._fit_component, tasks)
+
+        # labels of each block are shifted by the position of the block
+        labels = np.empty_like(index)
+        for (start, end), labels_block in zip(blocks, labels_blocks):
+            labels[index[start:end]] = start + labels_block
+        _, labels = np.unique(labels, return_inverse=True)
+        return labels
+
     def fit(self, adjacency: Union[sparse.csr_matrix, np.ndarray]) -> 'Louvain':
         """Fit algorithm to the data.
 
@@ -187,48 +335,36 @@ class Louvain(BaseClustering, VerboseMixin):
             probs_in = check_probs('degree', adjacency.T)
         else:
             raise ValueError('Unknown modularity function.')
+        # single precision is used throughout the optimization
+        probs_ou = probs_ou.astype(np.float32)
+        probs_in = probs_in.astype(np.float32)
 
-        nodes = np.arange(n)
         if self.shuffle_nodes:
-            nodes = self.random_state.permutation(nodes)
-            adjacency = adjacency[nodes, :].tocsc()[:, nodes].tocsr()
+            nodes = self.random_state.permutation(n)
+        else:
+            nodes = None
 
-        adjacency_clust = adjacency / adjacency.data.sum()
+        # the objective only depends on the symmetrized adjacency, which is preserved by aggregation
+        adjacency_clust = adjacency.astype(np.float32)
+        adjacency_clust.data /= adjacency.data.sum()
+        adjacency_clust = adjacency_clust + adjacency_clust.T
+        adjacency_clust.data *= 0.5
 
-        membership = sparse.identity(n, format='csr')
-        increase = True
-        count_aggregations = 0
         self.log.print("Starting with", n, "nodes.")
-        while increase:
-            count_aggregations += 1
-
-            labels_clust, pass_increase = self._optimize(adjacency_clust, probs_ou, probs_in)
-            _, labels_clust = np.unique(labels_clust, return_inverse=True)
-
-            if pass_increase <= self.tol_aggregation:
-                increase = False
-            else:
-                membership_clust = membership_matrix(labels_clust)
-                membership = membership.dot(membership_clust)
-                adjacency_clust, probs_ou, probs_in = self._aggregate(adjacency_clust, probs_ou, probs_in,
-                                                                      membership_clust)
-
-                n = adjacency_clust.shape[0]
-                if n == 1:
-                    break
-            self.log.print("Aggregation", count_aggregations, "completed with", n, "clusters and ",
-                           pass_increase, "increment.")
-            if count_aggregations == self.n_aggregations:
-                break
+        n_jobs = check_n_jobs(self.n_jobs)
+        n_components, components = 1, None
+        # connected components are only computed by scipy for 32-bit indices
+        if n_jobs != 1 and max(n, adjacency.nnz) < 2 ** 31:
+            adjacency_32 = sparse.csr_matrix((adjacency.data, adjacency.indices.astype(np.int32),
+                                              adjacency.indptr.astype(np.int32)), shape=adjacency.shape)
+            n_components, components = sparse.csgraph.connected_components(adjacency_32, directed=False)
+        if n_components > 1:
+            labels = self._fit_components(adjacency_clust, probs_ou, probs_in, nodes, components, n_jobs)
+        else:
+            labels = self._fit_component(adjacency_clust, probs_ou, probs_in, nodes, parallelize=self.parallelize)
 
         if self.sort_clusters:
-            labels = reindex_labels(membership.indices)
-        else:
-            labels = membership.indices
-        if self.shuffle_nodes:
-            reverse = np.empty(nodes.size, nodes.dtype)
-            reverse[nodes] = np.arange(nodes.size)
-            labels = labels[reverse]
+            labels = reindex_labels(labels)
 
         self.labels_ = labels
         self._secondary_outputs(adjacency)
@@ -255,7 +391,17 @@ class BiLouvain(Louvain, BaseBiClustering):
         Maximum number of aggregations.
         A negative value is interpreted as no limit.
     shuffle_nodes :
-        Enables node shuffling before optimization.
+        Enables node shuffling before optimization. The order of the nodes is then carried over to the aggregate graphs.
+    parallelize :
+        If ``True``, search the best move of each node in parallel during each optimization pass.
+        Moves are searched from the labels at the start of the pass, then applied sequentially.
+        The number of threads is that of OpenMP (see ``OMP_NUM_THREADS``), each using extra memory linear in the
+        number of nodes.
+    n_jobs :
+        If an integer value is given, denotes the number of workers to use (-1 means the maximum number will be used).
+        Connected components are then clustered independently, in parallel.
+        If the graph has several connected components, this takes precedence over ``parallelize``.
+        If ``None``, no parallel computations are made.
     sort_clusters :
             If ``True``, sort labels in decreasing order of cluster size.
     return_membership :
@@ -294,13 +440,15 @@ class BiLouvain(Louvain, BaseBiClustering):
     """
     def __init__(self, resolution: float = 1, modularity: str = 'dugue', tol_optimization: float = 1e-3,
                  tol_aggregation: float = 1e-3, n_aggregations: int = -1, shuffle_nodes: bool = False,
-                 sort_clusters: bool = True, return_membership: bool = True, return_aggregate: bool = True,
+                 parallelize: bool = False, n_jobs: Optional[int] = None, sort_clusters: bool = True,
+                 return_membership: bool = True, return_aggregate: bool = True,
                  random_state: Optional[Union[np.random.RandomState, int]] = None, verbose: bool = False):
         super(BiLouvain, self).__init__(sort_clusters=sort_clusters, return_membership=return_membership,
                                         return_aggregate=return_aggregate, resolution=resolution, modularity=modularity,
                                         tol_optimization=tol_optimization, verbose=verbose,
                                         tol_aggregation=tol_aggregation, n_aggregations=n_aggregations,
-                                        shuffle_nodes=shuffle_nodes, random_state=random_state)
+                                        shuffle_nodes=shuffle_nodes, parallelize=parallelize, n_jobs=n_jobs,
+                                        random_state=random_state)
 
     def fit(self, biadjacency: Union[sparse.csr_matrix, np.ndarray]) -> 'BiLouvain':
         """Apply the Louvain algorithm to the corresponding directed graph, with adjacency matrix:
@@ -320,8 +468,9 @@ class BiLouvain(Louvain, BaseBiClustering):
         """
         louvain = Louvain(resolution=self.resolution, modularity=self.modularity, tol_aggregation=self.tol_aggregation,
                           n_aggregations=self.n_aggregations, shuffle_nodes=self.shuffle_nodes,
-                          sort_clusters=self.sort_clusters, return_membership=self.return_membership,
-                          return_aggregate=False, random_state=self.random_state, verbose=self.log.verbose)
+                          parallelize=self.parallelize, n_jobs=self.n_jobs, sort_clusters=self.sort_clusters,
+                          return_membership=self.return_membership, return_aggregate=False,
+                          random_state=self.random_state, verbose=self.log.verbose)
         biadjacency = check_format(biadjacency)
         n_row, _ = biadjacency.shape
 
@@ -2,18 +2,95 @@
 # cython: language_level=3
 # cython: linetrace=True
 # distutils: define_macros=CYTHON_TRACE_NOGIL=1
-from libcpp.set cimport set
+from libc.stdlib cimport calloc, free, malloc
 from libcpp.vector cimport vector
+from cython.parallel cimport prange
 cimport cython
 
+import numpy as np
+
+cdef extern from *:
+    """
+    #ifdef _OPENMP
+    #include <omp.h>
+    #else
+    static int omp_get_max_threads(void) { return 1; }
+    #endif
+    """
+    int omp_get_max_threads() nogil
+
 ctypedef fused int_or_long:
     int
     long
 
 @cython.boundscheck(False)
 @cython.wraparound(False)
-def fit_core(float resolution, float tol, float[:] ou_node_probs, float[:] in_node_probs, float[:] self_loops,
-             float[:] data, int_or_long[:] indices, int_or_long[:] indptr):  # pragma: no cover
+@cython.cdivision(True)
+@cython.linetrace(False)
+@cython.profile(False)
+cdef inline float find_best_cluster(int_or_long i, int_or_long* labels, float* data, int_or_long* indices,
+                                    int_or_long* indptr, float* self_loops, float* ou_node_probs,
+                                    float* in_node_probs, float* clusters_weights, float* node_ratios,
+                                    float* neighbor_clusters_weights, int_or_long* neighbor_clusters,
+                                    int_or_long* cluster_best) nogil:
+    """Find the neighbor cluster of node i giving the largest increase in modularity.
+
+    The best cluster is written in ``cluster_best`` (the current cluster of node i if no move increases modularity)
+    and the corresponding increase is returned. The sparse accumulator ``neighbor_clusters_weights`` is left at zero.
+    """
+    cdef int_or_long cluster
+    cdef int_or_long cluster_node = labels[i]
+    cdef int_or_long j
+    cdef int_or_long k
+    cdef int_or_long label
+    cdef int_or_long n_clusters = 0
+    cdef float delta_best = 0
+    cdef float delta_exit
+    cdef float delta_local
+    cdef float ratio_in = node_ratios[2 * i + 1]
+    cdef float ratio_ou = node_ratios[2 * i]
+
+    cluster_best[0] = cluster_node
+    # isolated node
+    if indptr[i] == indptr[i + 1]:
+        return 0
+
+    # sparse accumulator: only the clusters listed in neighbor_clusters have non-zero weights
+    for j in range(indptr[i], indptr[i + 1]):
+        label = labels[indices[j]]
+        if neighbor_clusters_weights[label] == 0:
+            neighbor_clusters[n_clusters] = label
+            n_clusters += 1
+        neighbor_clusters_weights[label] += data[j]
+
+    delta_exit = 2 * (neighbor_clusters_weights[cluster_node] - self_loops[i])
+    delta_exit -= ratio_ou * (clusters_weights[2 * cluster_node + 1] - in_node_probs[i])
+    delta_exit -= ratio_in * (clusters_weights[2 * cluster_node] - ou_node_probs[i])
+
+    for k in range(n_clusters):
+        cluster = neighbor_clusters[k]
+        if cluster != cluster_node:
+            delta_local = 2 * neighbor_clusters_weights[cluster]
+            delta_local -= ratio_ou * clusters_weights[2 * cluster + 1]
+            delta_local -= ratio_in * clusters_weights[2 * cluster]
+            delta_local -= delta_exit
+            if delta_local > delta_best:
+                delta_best = delta_local
+                cluster_best[0] = cluster
+
+    for k in range(n_clusters):
+        neighbor_clusters_weights[neighbor_clusters[k]] = 0
+
+    return delta_best
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.initializedcheck(False)
+@cython.cdivision(True)
+@cython.linetrace(False)
+def fit_core(float resolution, float tol, float[::1] ou_node_probs, float[::1] in_node_probs,
+             float[::1] self_loops, float[::1] data, int_or_long[::1] indices, int_or_long[::1] indptr,
+             int_or_long[::1] nodes, bint parallelize=False):  # pragma: no cover
     """Fit the clusters to the objective function.
 
     Parameters
@@ -34,6 +111,12 @@ def fit_core(float resolution, float tol, float[:] ou_node_probs, float[:] in_no
         CSR format index array of the normalized adjacency matrix.
     indptr :
         CSR format index pointer array of the normalized adjacency matrix.
+    nodes :
+        Order in which the nodes are considered for local moves.
+    parallelize :
+        If ``True``, the best move of each node is searched in parallel from the labels at the start of the pass,
+        then the moves are applied sequentially, provided they still increase the objective function.
+        Each OpenMP thread uses its own accumulator of size n.
 
     Returns
     -------
@@ -44,14 +127,16 @@ def fit_core(float resolution, float tol, float[:] ou_node_probs, float[:] in_no
     """
     cdef int_or_long n = indptr.shape[0] - 1
     cdef int_or_long increase = 1
-    cdef int_or_long cluster
     cdef int_or_long cluster_best
     cdef int_or_long cluster_node
     cdef int_or_long i
     cdef int_or_long j
-    cdef int_or_long j1
-    cdef int_or_long j2
     cdef int_or_long label
+    cdef int_or_long node_index
+    cdef int_or_long block
+    cdef int_or_long n_blocks = 1
+    cdef int_or_long* local_clusters
+    cdef int_or_long* blocks_clusters = NULL
 
     cdef float increase_total = 0
     cdef float increase_pass
@@ -63,72 +148,203 @@ def fit_core(float resolution, float tol, float[:] ou_node_probs, float[:] in_no
     cdef float node_prob_ou
     cdef float ratio_in
     cdef float ratio_ou
+    cdef float weight_best
+    cdef float weight_node
+    cdef float* local_clusters_weights
+    cdef float* blocks_clusters_weights = NULL
 
     cdef vector[int_or_long] labels
+    cdef vector[int_or_long] labels_best
     cdef vector[float] neighbor_clusters_weights
-    cdef vector[float] ou_clusters_weights
-    cdef vector[float] in_clusters_weights
-    cdef set[int_or_long] unique_clusters = ()
+    # out- and in-weights of each cluster (resp. node) are stored contiguously
+    cdef vector[float] clusters_weights
+    cdef vector[float] node_ratios
+    cdef vector[int_or_long] neighbor_clusters
 
     for i in range(n):
         labels.push_back(i)
-        neighbor_clusters_weights.push_back(0.)
-        ou_clusters_weights.push_back(ou_node_probs[i])
-        in_clusters_weights.push_back(in_node_probs[i])
+        clusters_weights.push_back(ou_node_probs[i])
+        clusters_weights.push_back(in_node_probs[i])
+        node_ratios.push_back(resolution * ou_node_probs[i])
+        node_ratios.push_back(resolution * in_node_probs[i])
+    if not parallelize:
+        neighbor_clusters_weights.resize(n, 0)
+        neighbor_clusters.resize(n)
+    else:
+        labels_best.resize(n)
+        # one sparse accumulator per block of nodes and thread, allocated once for all passes
+        n_blocks = min(omp_get_max_threads(), n)
+        blocks_clusters_weights = <float*> calloc(<size_t> n_blocks * n, sizeof(float))
+        blocks_clusters = <int_or_long*> malloc(<size_t> n_blocks * n * sizeof(int_or_long))
+        if blocks_clusters_weights == NULL or blocks_clusters == NULL:
+            free(blocks_clusters_weights)
+            free(blocks_clusters)
+            raise MemoryError()
 
-    while increase == 1:
-        increase = 0
-        increase_pass = 0
+    with nogil:
+        while increase == 1:
+            increase = 0
+            increase_pass = 0
 
-        for i in range(n):
-            unique_clusters.clear()
-            cluster_node = labels[i]
-            j1 = indptr[i]
-            j2 = indptr[i + 1]
-
-            for j in range(j1, j2):
-                label = labels[indices[j]]
-                neighbor_clusters_weights[label] += data[j]
-                unique_clusters.insert(label)
-
-            unique_clusters.erase(cluster_node)
-
-            if not unique_clusters.empty():
-                node_prob_ou = ou_node_probs[i]
-                node_prob_in = in_node_probs[i]
-                ratio_ou = resolution * node_prob_ou
-                ratio_in = resolution * node_prob_in
-
-                delta_exit = 2 * (neighbor_clusters_weights[cluster_node] - self_loops[i])
-                delta_exit -= ratio_ou * (in_clusters_weights[cluster_node] - node_prob_in)
-                delta_exit -= ratio_in * (ou_clusters_weights[cluster_node] - node_prob_ou)
-
-                delta_best = 0
-                cluster_best = cluster_node
-
-                for cluster in unique_clusters:
-                    delta = 2 * neighbor_clusters_weights[cluster]
-                    delta -= ratio_ou * in_clusters_weights[cluster]
-                    delta -= ratio_in * ou_clusters_weights[cluster]
-
-                    delta_local = delta - delta_exit
-                    if delta_local > delta_best:
-                        delta_best = delta_local
-                        cluster_best = cluster
-
-                    neighbor_clusters_weights[cluster] = 0
-
-                if delta_best > 0:
-                    increase_pass += delta_best
-                    ou_clusters_weights[cluster_node] -= node_prob_ou
-                    in_clusters_weights[cluster_node] -= node_prob_in
-                    ou_clusters_weights[cluster_best] += node_prob_ou
-                    in_clusters_weights[cluster_best] += node_prob_in
-                    labels[i] = cluster_best
-
-            neighbor_clusters_weights[cluster_node] = 0
-
-        increase_total += increase_pass
-        if increase_pass > tol:
-            increase = 1
+            if parallelize:
+                for block in prange(n_blocks, schedule='dynamic'):
+                    local_clusters_weights = blocks_clusters_weights + <size_t> block * n
+                    local_clusters = blocks_clusters + <size_t> block * n
+
+                    for i in range(<size_t> block * n // n_blocks, <size_t> (block + 1) * n // n_blocks):
+                        find_best_cluster(i, labels.data(), &data[0], &indices[0], &indptr[0], &self_loops[0],
+                                          &ou_node_probs[0], &in_node_probs[0], clusters_weights.data(),
+                                          node_ratios.data(), local_clusters_weights, local_clusters,
+                                          &labels_best[i])
+
+                # sequential application of the moves, with the current labels
+                for node_index in range(n):
+                    i = nodes[node_index]
+                    cluster_node = labels[i]
+                    cluster_best = labels_best[i]
+                    if cluster_best != cluster_node:
+                        weight_node = 0
+                        weight_best = 0
+                        for j in range(indptr[i], indptr[i + 1]):
+                            label = labels[indices[j]]
+                            if label == cluster_node:
+                                weight_node += data[j]
+                            elif label == cluster_best:
+                                weight_best += data[j]
+
+                        node_prob_ou = ou_node_probs[i]
+                        node_prob_in = in_node_probs[i]
+                        ratio_ou = node_ratios[2 * i]
+                        ratio_in = node_ratios[2 * i + 1]
+
+                        delta_exit = 2 * (weight_node - self_loops[i])
+                        delta_exit -= ratio_ou * (clusters_weights[2 * cluster_node + 1] - node_prob_in)
+                        delta_exit -= ratio_in * (clusters_weights[2 * cluster_node] - node_prob_ou)
+
+                        delta = 2 * weight_best
+                        delta -= ratio_ou * clusters_weights[2 * cluster_best + 1]
+                        delta -= ratio_in * clusters_weights[2 * cluster_best]
+
+                        delta_local = delta - delta_exit
+                        if delta_local > 0:
+                            increase_pass += delta_local
+                            clusters_weights[2 * cluster_node] -= node_prob_ou
+                            clusters_weights[2 * cluster_node + 1] -= node_prob_in
+                            clusters_weights[2 * cluster_best] += node_prob_ou
+                            clusters_weights[2 * cluster_best + 1] += node_prob_in
+                            labels[i] = cluster_best
+            else:
+                for node_index in range(n):
+                    i = nodes[node_index]
+                    cluster_node = labels[i]
+                    delta_best = find_best_cluster(i, labels.data(), &data[0], &indices[0], &indptr[0],
+                                                   &self_loops[0], &ou_node_probs[0], &in_node_probs[0],
+                                                   clusters_weights.data(), node_ratios.data(),
+                                                   neighbor_clusters_weights.data(), neighbor_clusters.data(),
+                                                   &cluster_best)
+                    if delta_best > 0:
+                        node_prob_ou = ou_node_probs[i]
+                        node_prob_in = in_node_probs[i]
+                        increase_pass += delta_best
+                        clusters_weights[2 * cluster_node] -= node_prob_ou
+                        clusters_weights[2 * cluster_node + 1] -= node_prob_in
+                        clusters_weights[2 * cluster_best] += node_prob_ou
+                        clusters_weights[2 * cluster_best + 1] += node_prob_in
+                        labels[i] = cluster_best
+
+            increase_total += increase_pass
+            if increase_pass > tol:
+                increase = 1
+    free(blocks_clusters_weights)
+    free(blocks_clusters)
     return labels, increase_total
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.initializedcheck(False)
+@cython.linetrace(False)
+def aggregate_core(float[::1] data, int_or_long[::1] indices, int_or_long[::1] indptr, int_or_long[::1] labels,
+                   int_or_long n_labels):  # pragma: no cover
+    """Aggregate the nodes of a graph belonging to the same cluster.
+
+    Parameters
+    ----------
+    data :
+        CSR format data array of the normalized adjacency matrix.
+    indices :
+        CSR format index array of the normalized adjacency matrix.
+    indptr :
+        CSR format index pointer array of the normalized adjacency matrix.
+    labels :
+        Cluster of each node (from 0 to n_labels - 1).
+    n_labels :
+        Number of clusters.
+
+    Returns
+    -------
+    data, indices, indptr :
+        CSR format arrays of the aggregate adjacency matrix (indices are not sorted).
+    """
+    cdef int_or_long n = indptr.shape[0] - 1
+    cdef int_or_long cluster
+    cdef int_or_long count = 0
+    cdef int_or_long i
+    cdef int_or_long j
+    cdef int_or_long k
+    cdef int_or_long label
+    cdef int_or_long n_neighbors
+
+    cdef vector[int_or_long] clusters_indptr
+    cdef vector[int_or_long] clusters_nodes
+    cdef vector[int_or_long] position
+    cdef vector[int_or_long] neighbors
+    cdef vector[int_or_long] marker
+    cdef vector[float] weights
+
+    dtype = np.asarray(indices).dtype
+    data_agg = np.empty(indptr[n], dtype=np.float32)
+    indices_agg = np.empty(indptr[n], dtype=dtype)
+    indptr_agg = np.zeros(n_labels + 1, dtype=dtype)
+    cdef float[::1] data_view = data_agg
+    cdef int_or_long[::1] indices_view = indices_agg
+    cdef int_or_long[::1] indptr_view = indptr_agg
+
+    clusters_indptr.resize(n_labels + 1, 0)
+    clusters_nodes.resize(n)
+    neighbors.resize(n_labels)
+    marker.resize(n_labels, -1)
+    weights.resize(n_labels, 0)
+
+    with nogil:
+        # nodes grouped by cluster (counting sort)
+        for i in range(n):
+            clusters_indptr[labels[i] + 1] += 1
+        for cluster in range(n_labels):
+            clusters_indptr[cluster + 1] += clusters_indptr[cluster]
+        position = clusters_indptr
+        for i in range(n):
+            clusters_nodes[position[labels[i]]] = i
+            position[labels[i]] += 1
+
+        # one row of the aggregate graph per cluster, with a sparse accumulator over the neighbor clusters
+        for cluster in range(n_labels):
+            n_neighbors = 0
+            for k in range(clusters_indptr[cluster], clusters_indptr[cluster + 1]):
+                i = clusters_nodes[k]
+                for j in range(indptr[i], indptr[i + 1]):
+                    label = labels[indices[j]]
+                    if marker[label] != cluster:
+                        marker[label] = cluster
+                        weights[label] = 0
+                        neighbors[n_neighbors] = label
+                        n_neighbors += 1
+                    weights[label] += data[j]
+            for k in range(n_neighbors):
+                label = neighbors[k]
+                indices_view[count] = label
+                data_view[count] = weights[label]
+                count += 1
+            indptr_view[cluster + 1] = count
+
+    return data_agg[:count].copy(), indices_agg[:count].copy(), indptr_agg
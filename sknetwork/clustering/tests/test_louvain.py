@@ -3,7 +3,7 @@
 """Tests for Louvain"""
 import unittest
 
-from sknetwork.clustering import Louvain, BiLouvain
+from sknetwork.clustering import Louvain, BiLouvain, modularity
 from sknetwork.data import karate_club, star_wars
 from sknetwork.data.test_graphs import *
 from sknetwork.utils import bipartite2undirected
@@ -56,7 +56,7 @@ class TestLouvainClustering(unittest.TestCase):
         # shuffling
         louvain = Louvain(resolution=2, shuffle_nodes=True, random_state=42)
         labels = louvain.fit_transform(adjacency)
-        self.assertEqual(len(set(labels)), 9)
+        self.assertEqual(len(set(labels)), 7)
 
         # aggregate graph
         louvain = Louvain(return_aggregate=True)
@@ -67,6 +67,46 @@ class TestLouvainClustering(unittest.TestCase):
         # aggregate graph
         Louvain(n_aggregations=1, sort_clusters=False).fit(adjacency)
 
+    def test_parallelize(self):
+        adjacency = karate_club()
+        labels = Louvain().fit_transform(adjacency)
+        labels_parallel = Louvain(parallelize=True).fit_transform(adjacency)
+        self.assertEqual(len(labels_parallel), adjacency.shape[0])
+        self.assertAlmostEqual(modularity(adjacency, labels_parallel), modularity(adjacency, labels), delta=0.05)
+
+        biadjacency = star_wars()
+        bilouvain = BiLouvain(parallelize=True)
+        bilouvain.fit(biadjacency)
+        self.assertEqual(len(bilouvain.labels_col_), biadjacency.shape[1])
+
+    def test_components(self):
+        # many small components
+        clique = sparse.csr_matrix(np.ones((5, 5)) - np.eye(5))
+        adjacency = sparse.block_diag([karate_club()] * 5 + [clique] * 2000 + [test_graph_disconnect()], format='csr')
+        score = modularity(adjacency, Louvain().fit_transform(adjacency))
+        for n_jobs in [2, 3, -1]:
+            for shuffle_nodes in [False, True]:
+                louvain = Louvain(n_jobs=n_jobs, shuffle_nodes=shuffle_nodes, random_state=0)
+                labels_jobs = louvain.fit_transform(adjacency)
+                self.assertAlmostEqual(modularity(adjacency, labels_jobs), score, delta=0.01)
+
+        # moves are searched sequentially in each worker
+        labels = Louvain(n_jobs=2).fit_transform(adjacency)
+        labels_parallel = Louvain(n_jobs=2, parallelize=True).fit_transform(adjacency)
+        self.assertTrue((labels == labels_parallel).all())
+
+        # 64-bit index
+        adjacency.indices = adjacency.indices.astype(np.int64)
+        adjacency.indptr = adjacency.indptr.astype(np.int64)
+        labels_64 = Louvain(n_jobs=2).fit_transform(adjacency)
+        self.assertTrue((labels == labels_64).all())
+
+        # single component
+        adjacency = karate_club()
+        labels = Louvain().fit_transform(adjacency)
+        labels_jobs = Louvain(n_jobs=2).fit_transform(adjacency)
+        self.assertTrue((labels == labels_jobs).all())
+
     def test_options_with_64_bit(self):
         adjacency = karate_club()
         # force 64-bit index
@@ -86,7 +126,7 @@ class TestLouvainClustering(unittest.TestCase):
         # shuffling
         louvain = Louvain(resolution=2, shuffle_nodes=True, random_state=42)
         labels = louvain.fit_transform(adjacency)
-        self.assertEqual(len(set(labels)), 9)
+        self.assertEqual(len(set(labels)), 7)
 
         # aggregate graph
         louvain = Louvain(return_aggregate=True)